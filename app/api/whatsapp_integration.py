@@ -1,18 +1,27 @@
 # servidor/modulo-ia/app/api/whatsapp_integration.py
 
 from fastapi import APIRouter, HTTPException, Depends
-from pydantic import BaseModel
-from typing import Optional, Dict, List, Any
-from datetime import datetime
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field
+from typing import Optional, Dict, List, Any, Annotated
+from collections import defaultdict
+from datetime import datetime, timezone
+from time import time
+import asyncio
 import logging
+import re
+
+import ahocorasick
+from cachetools import TTLCache
 
 from app.services.ia_service import (
-    ask_mistral_with_context,
+    ask_mistral_with_context_async,
     get_suggested_titles,
     format_topics_inline,
     summarize_pdf,
     get_index_overview
 )
+from app.services.llm_batcher import llm_queue
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
@@ -20,40 +29,229 @@ logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/api/ia", tags=["WhatsApp IA Integration"])
 
+# --- Patrones de extracción (compilados una sola vez) -----------------
+PRICE_PATTERNS = [
+    re.compile(r'(\d+\.?\d*)\s*(?:mil|k)\s*(?:bs|bolivianos)?'),
+    re.compile(r'(\d{4,})\s*(?:bs|bolivianos)?'),
+    re.compile(r'entre\s*(\d+\.?\d*)\s*y\s*(\d+\.?\d*)'),
+]
+BEDROOM_RE = re.compile(r'(\d+)\s*(?:dormitorio|habitacion|cuarto)')
+BATHROOM_RE = re.compile(r'(\d+)\s*baño')
+
+# --- Detección de intención (una sola pasada, grupos con nombre) ------
+# Solo \b inicial: evita falsos positivos ("ya" en "playa") sin perder plurales
+INTENT_RE = re.compile(
+    r'\b(?:'
+    r'(?P<visit>visitar|ver|conocer|cita|agendar)'
+    r'|(?P<price>precio|costo|vale|cuesta|presupuesto)'
+    r'|(?P<location>zona|ubicación|dirección|dónde|barrio)'
+    r'|(?P<availability>disponible|libre|ocupado|alquiler|venta)'
+    r')'
+)
+
+def _detect_intents(query_lower: str) -> set:
+    """Conjunto de intenciones presentes: visit, price, location, availability."""
+    return {m.lastgroup for m in INTENT_RE.finditer(query_lower)}
+
+# --- Vocabularios de preferencias (un solo autómata Aho–Corasick) -----
+LOCATIONS = ('equipetrol', 'zona norte', 'zona sur', 'centro', 'urubo', 'la guardia')
+# Orden = prioridad cuando el mensaje menciona varios tipos
+PROPERTY_TYPES = {
+    'casa': 'casa',
+    'departamento': 'departamento',
+    'depto': 'departamento',
+    'terreno': 'terreno',
+    'oficina': 'oficina',
+}
+FEATURE_KEYWORDS = {
+    'piscina': 'piscina',
+    'garage': 'garage',
+    'jardin': 'jardín',
+    'parrillero': 'parrillero',
+    'seguridad': 'seguridad 24/7',
+    'amoblado': 'amoblado',
+    'balcon': 'balcón'
+}
+URGENCY_KEYWORDS = {
+    'alta': ('urgente', 'pronto', 'ya', 'inmediato', 'hoy'),
+    'media': ('próximo mes', 'próxima semana'),
+}
+
+def _build_keyword_automaton() -> ahocorasick.Automaton:
+    """Indexa cada palabra clave de los vocabularios con su etiqueta (categoría, palabra, valor)."""
+    automaton = ahocorasick.Automaton()
+    for loc in LOCATIONS:
+        automaton.add_word(loc, ("location", loc, loc))
+    for keyword, ptype in PROPERTY_TYPES.items():
+        automaton.add_word(keyword, ("ptype", keyword, ptype))
+    for keyword, feature in FEATURE_KEYWORDS.items():
+        automaton.add_word(keyword, ("feature", keyword, feature))
+    for level, words in URGENCY_KEYWORDS.items():
+        for word in words:
+            automaton.add_word(word, ("urgency", word, level))
+    automaton.make_automaton()
+    return automaton
+
+KEYWORD_AUTOMATON = _build_keyword_automaton()
+
+def _scan_keywords(text: str) -> Dict[str, set]:
+    """
+    Recorre `text` una sola vez y devuelve {categoría: {valores}}.
+    Igual que en las regex de intención, la palabra clave debe empezar en un límite de palabra.
+    """
+    hits = defaultdict(set)
+    for end, (category, keyword, value) in KEYWORD_AUTOMATON.iter(text):
+        start = end - len(keyword) + 1
+        if start > 0 and text[start - 1].isalnum():
+            continue
+        hits[category].add(value)
+    return hits
+
+# --- Caché de sugerencias FAISS (deterministas para la misma consulta) -
+_titles_cache = TTLCache(maxsize=4096, ttl=60)
+
+async def _cached_suggested_titles(query: str, max_suggestions: int = 3) -> List[str]:
+    """get_suggested_titles memorizado por (consulta exacta, k) durante un TTL corto."""
+    # Clave con el texto tal cual: el modelo de embeddings distingue mayúsculas
+    key = (query, max_suggestions)
+    titles = _titles_cache.get(key)
+    if titles is None:
+        titles = await asyncio.to_thread(get_suggested_titles, query, max_suggestions)
+        _titles_cache[key] = titles
+    return titles
+
+# --- Snapshot del índice para /health (refrescado en segundo plano) ---
+_health_snapshot: Dict = {"total_chunks": 0, "pdfs": []}
+
+async def refresh_overview_loop(interval: float = 30) -> None:
+    """
+    Refresca el snapshot del índice FAISS cada `interval` segundos.
+    /health solo lee el snapshot, nunca toca FAISS.
+    """
+    global _health_snapshot
+    while True:
+        try:
+            overview = await asyncio.to_thread(get_index_overview)
+            # Reasignación atómica: los lectores ven el snapshot viejo o el nuevo
+            _health_snapshot = {"total_chunks": overview["total_chunks"], "pdfs": overview.get("pdfs", [])}
+        except Exception as e:
+            logger.error(f"Error refrescando snapshot del índice: {str(e)}")
+        await asyncio.sleep(interval)
+
+# --- Respuestas fijas ------------------------------------------------
+VISIT_RESPONSE = (
+    "Entiendo que te gustaría visitar la propiedad. "
+    "Un agente se pondrá en contacto contigo pronto para coordinar una visita. "
+    "¿Hay algún horario que prefieras?"
+)
+PRICE_FALLBACK = (
+    "Te puedo ayudar con información sobre precios de nuestras propiedades. "
+    "¿Qué tipo de propiedad te interesa? ¿Casa, departamento o terreno? "
+    "También sería útil saber en qué zona estás buscando."
+)
+LOCATION_FALLBACK = (
+    "Tenemos propiedades en varias zonas de la ciudad. "
+    "Las principales áreas disponibles son: Equipetrol, Zona Norte, "
+    "Urubó, y el Centro. ¿Cuál zona te interesa más?"
+)
+GENERIC_FALLBACK_HEAD = (
+    "Soy tu asistente inmobiliario virtual. Puedo ayudarte con:\n"
+    "• Información sobre propiedades disponibles\n"
+    "• Precios y características\n"
+    "• Ubicaciones y zonas\n"
+    "• Proceso de compra o alquiler\n"
+)
+GENERIC_FALLBACK_TAIL = "\n\n¿Qué información necesitas?"
+
+# --- Timestamp ISO cacheado a resolución de 1 s (probes frecuentes) ---
+_last_ts = [0, ""]
+
+def _now_iso() -> str:
+    t = int(time())
+    if t != _last_ts[0]:
+        _last_ts[:] = [t, datetime.fromtimestamp(t, timezone.utc).isoformat()]
+    return _last_ts[1]
+
 # ==================== SCHEMAS ====================
 
+HISTORY_WINDOW = 5        # mensajes del historial que se envían al LLM
+MAX_HISTORY_ITEMS = 50    # payloads más largos se rechazan con 422
+
+# Config común (Pydantic v2): ignorar campos desconocidos del gateway,
+# modelos mutables y sin validación en asignación
+SCHEMA_CONFIG = ConfigDict(
+    extra="ignore",
+    frozen=False,
+    str_strip_whitespace=False,
+    validate_assignment=False,
+)
+
 class PropertyQuery(BaseModel):
     """Esquema para consultas sobre propiedades"""
+    model_config = SCHEMA_CONFIG
+
     query: str
     client_phone: str
     agent_phone: str
-    conversation_history: Optional[List[Dict[str, str]]] = []
-    context: Optional[Dict[str, Any]] = {}
+    conversation_history: Optional[Annotated[list[dict[str, str]], Field(max_length=MAX_HISTORY_ITEMS)]] = []
+    context: Optional[dict[str, Any]] = {}
 
 class PropertyResponse(BaseModel):
     """Respuesta de IA para consultas de propiedades"""
+    model_config = SCHEMA_CONFIG
+
     success: bool
     response: str
-    suggestions: Optional[List[str]] = []
-    properties_mentioned: Optional[List[Dict]] = []
+    suggestions: Optional[list[str]] = []
+    properties_mentioned: Optional[list[dict]] = []
     requires_human: bool = False
-    metadata: Optional[Dict] = {}
+    metadata: Optional[dict] = {}
 
 class ClientAnalysis(BaseModel):
     """Análisis de preferencias del cliente"""
+    model_config = SCHEMA_CONFIG
+
     query: str
     client_phone: str
     
 class ClientPreferences(BaseModel):
     """Preferencias extraídas del cliente"""
-    budget_range: Optional[Dict[str, float]] = None
-    location_preferences: Optional[List[str]] = []
+    model_config = SCHEMA_CONFIG
+
+    budget_range: Optional[dict[str, float]] = None
+    location_preferences: Optional[list[str]] = []
     property_type: Optional[str] = None
     bedrooms: Optional[int] = None
     bathrooms: Optional[int] = None
-    additional_features: Optional[List[str]] = []
+    additional_features: Optional[list[str]] = []
     urgency: Optional[str] = None  # "alta", "media", "baja"
 
+# ==================== HELPERS ====================
+
+def _build_history(conversation_history: Optional[List[Dict[str, str]]]) -> str:
+    """Historial compacto con los últimos HISTORY_WINDOW intercambios."""
+    if not conversation_history:
+        return ""
+    history_items = conversation_history[-HISTORY_WINDOW:]
+    history_lines = [""] * (2 * len(history_items))
+    for i, msg in enumerate(history_items):
+        question = msg.get('question', '')
+        answer = msg.get('answer', '')
+        history_lines[2 * i] = f"Cliente: {question}"
+        history_lines[2 * i + 1] = f"Asistente: {answer}"
+    return "\n".join(history_lines)
+
+def _fallback_response_text(is_price_query: bool, is_location_query: bool, suggestions: List[str]) -> str:
+    """Respuesta útil sobre propiedades cuando el RAG no encuentra contexto."""
+    if is_price_query:
+        return PRICE_FALLBACK
+    if is_location_query:
+        return LOCATION_FALLBACK
+    topics_line = format_topics_inline(suggestions) if suggestions else ""
+    if topics_line:
+        return f"{GENERIC_FALLBACK_HEAD}\nTambién puedo informarte sobre: {topics_line}{GENERIC_FALLBACK_TAIL}"
+    return GENERIC_FALLBACK_HEAD + GENERIC_FALLBACK_TAIL
+
 # ==================== ENDPOINTS ====================
 
 @router.post("/process-query", response_model=PropertyResponse)
@@ -65,77 +263,40 @@ async def process_property_query(request: PropertyQuery):
     try:
         logger.info(f"Procesando consulta de {request.client_phone}: {request.query[:100]}...")
         
-        # Construir historial de conversación
-        history = ""
-        if request.conversation_history:
-            history_lines = []
-            for msg in request.conversation_history[-5:]:  # Últimos 5 mensajes
-                history_lines.append(f"Cliente: {msg.get('question', '')}")
-                history_lines.append(f"Asistente: {msg.get('answer', '')}")
-            history = "\n".join(history_lines)
-        
         # Analizar el tipo de consulta
         query_lower = request.query.lower()
         
         # Detectar intenciones específicas del dominio inmobiliario
-        is_price_query = any(word in query_lower for word in ['precio', 'costo', 'vale', 'cuesta', 'presupuesto'])
-        is_location_query = any(word in query_lower for word in ['zona', 'ubicación', 'dirección', 'dónde', 'barrio'])
-        is_availability_query = any(word in query_lower for word in ['disponible', 'libre', 'ocupado', 'alquiler', 'venta'])
-        is_visit_request = any(word in query_lower for word in ['visitar', 'ver', 'conocer', 'cita', 'agendar'])
+        intents = _detect_intents(query_lower)
+        is_price_query = "price" in intents
+        is_location_query = "location" in intents
+        is_availability_query = "availability" in intents
+        is_visit_request = "visit" in intents
         
         # Si es una solicitud de visita, marcar para intervención humana
         if is_visit_request:
-            response_text = (
-                "Entiendo que te gustaría visitar la propiedad. "
-                "Un agente se pondrá en contacto contigo pronto para coordinar una visita. "
-                "¿Hay algún horario que prefieras?"
-            )
             return PropertyResponse(
                 success=True,
-                response=response_text,
+                response=VISIT_RESPONSE,
                 requires_human=True,
                 metadata={"intent": "visit_request"}
             )
         
-        # Procesar con RAG para consultas sobre propiedades
-        result = ask_mistral_with_context(
-            query=request.query,
-            history=history
+        # Construir historial de conversación (solo para el camino RAG)
+        history = _build_history(request.conversation_history)
+        
+        # Procesar con RAG y, en paralelo, obtener sugerencias de propiedades
+        # (la búsqueda FAISS se solapa con la generación del LLM)
+        result, suggestions = await asyncio.gather(
+            llm_queue.submit(request.query, history),
+            _cached_suggested_titles(request.query, 3),
         )
         
         # Si no hay contexto suficiente, dar respuesta útil sobre propiedades
         if not result.get("used_context"):
-            # Obtener sugerencias de propiedades disponibles
-            suggestions = get_suggested_titles(request.query, max_suggestions=3)
-            
-            if is_price_query:
-                response_text = (
-                    "Te puedo ayudar con información sobre precios de nuestras propiedades. "
-                    "¿Qué tipo de propiedad te interesa? ¿Casa, departamento o terreno? "
-                    "También sería útil saber en qué zona estás buscando."
-                )
-            elif is_location_query:
-                response_text = (
-                    "Tenemos propiedades en varias zonas de la ciudad. "
-                    "Las principales áreas disponibles son: Equipetrol, Zona Norte, "
-                    "Urubó, y el Centro. ¿Cuál zona te interesa más?"
-                )
-            else:
-                topics_line = format_topics_inline(suggestions) if suggestions else ""
-                response_text = (
-                    "Soy tu asistente inmobiliario virtual. Puedo ayudarte con:\n"
-                    "• Información sobre propiedades disponibles\n"
-                    "• Precios y características\n"
-                    "• Ubicaciones y zonas\n"
-                    "• Proceso de compra o alquiler\n"
-                )
-                if topics_line:
-                    response_text += f"\nTambién puedo informarte sobre: {topics_line}"
-                response_text += "\n\n¿Qué información necesitas?"
-            
             return PropertyResponse(
                 success=True,
-                response=response_text,
+                response=_fallback_response_text(is_price_query, is_location_query, suggestions),
                 suggestions=suggestions,
                 requires_human=False,
                 metadata={"used_context": False}
@@ -145,7 +306,7 @@ async def process_property_query(request: PropertyQuery):
         return PropertyResponse(
             success=True,
             response=result.get("answer", ""),
-            suggestions=get_suggested_titles(request.query, max_suggestions=3),
+            suggestions=suggestions,
             requires_human=False,
             metadata={"used_context": True}
         )
@@ -154,6 +315,59 @@ async def process_property_query(request: PropertyQuery):
         logger.error(f"Error procesando consulta: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.post("/process-query/stream")
+async def process_property_query_stream(request: PropertyQuery):
+    """
+    Variante en streaming de /process-query: devuelve la respuesta del LLM
+    como texto plano a medida que se genera (menor tiempo al primer token).
+    Los metadatos viajan en cabeceras X-Requires-Human / X-Used-Context.
+    """
+    try:
+        logger.info(f"Procesando consulta (stream) de {request.client_phone}: {request.query[:100]}...")
+        
+        intents = _detect_intents(request.query.lower())
+        
+        if "visit" in intents:
+            return PlainTextResponse(
+                VISIT_RESPONSE,
+                headers={"X-Requires-Human": "true", "X-Intent": "visit_request"}
+            )
+        
+        history = _build_history(request.conversation_history)
+        # Comparte el límite de llamadas simultáneas con /process-query
+        stream = llm_queue.stream(request.query, history)
+        # Esperar el primer fragmento: sin contexto (o si el modelo falla) el generador no produce nada
+        first = await anext(stream, None)
+        
+        if first is None:
+            suggestions = await _cached_suggested_titles(request.query, 3)
+            response_text = _fallback_response_text(
+                "price" in intents, "location" in intents, suggestions
+            )
+            return PlainTextResponse(
+                response_text,
+                headers={"X-Requires-Human": "false", "X-Used-Context": "false"}
+            )
+        
+        async def body():
+            try:
+                yield first
+                async for piece in stream:
+                    yield piece
+            finally:
+                # Si el cliente se desconecta, cerrar ya la conexión con Ollama
+                await stream.aclose()
+        
+        return StreamingResponse(
+            body(),
+            media_type="text/plain; charset=utf-8",
+            headers={"X-Requires-Human": "false", "X-Used-Context": "true"}
+        )
+        
+    except Exception as e:
+        logger.error(f"Error procesando consulta (stream): {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @router.post("/analyze-preferences", response_model=ClientPreferences)
 async def analyze_client_preferences(request: ClientAnalysis):
     """
@@ -163,74 +377,50 @@ async def analyze_client_preferences(request: ClientAnalysis):
     try:
         query_lower = request.query.lower()
         preferences = ClientPreferences()
+        hits = _scan_keywords(query_lower)
         
         # Extraer rango de presupuesto
-        import re
-        price_patterns = [
-            r'(\d+\.?\d*)\s*(?:mil|k)\s*(?:bs|bolivianos)?',
-            r'(\d{4,})\s*(?:bs|bolivianos)?',
-            r'entre\s*(\d+\.?\d*)\s*y\s*(\d+\.?\d*)',
-        ]
-        
-        for pattern in price_patterns:
-            matches = re.findall(pattern, query_lower)
+        for pattern in PRICE_PATTERNS:
+            matches = pattern.findall(query_lower)
             if matches:
+                multiplier = 1000 if 'mil' in query_lower or 'k' in query_lower else 1
                 if isinstance(matches[0], tuple):
                     preferences.budget_range = {
-                        "min": float(matches[0][0]) * (1000 if 'mil' in query_lower or 'k' in query_lower else 1),
-                        "max": float(matches[0][1]) * (1000 if 'mil' in query_lower or 'k' in query_lower else 1)
+                        "min": float(matches[0][0]) * multiplier,
+                        "max": float(matches[0][1]) * multiplier
                     }
                 else:
-                    amount = float(matches[0]) * (1000 if 'mil' in query_lower or 'k' in query_lower else 1)
+                    amount = float(matches[0]) * multiplier
                     preferences.budget_range = {"min": amount * 0.8, "max": amount * 1.2}
                 break
         
         # Extraer preferencias de ubicación
-        locations = ['equipetrol', 'zona norte', 'zona sur', 'centro', 'urubo', 'la guardia']
-        preferences.location_preferences = [loc for loc in locations if loc in query_lower]
+        preferences.location_preferences = [loc for loc in LOCATIONS if loc in hits["location"]]
         
         # Extraer tipo de propiedad
-        if 'casa' in query_lower:
-            preferences.property_type = 'casa'
-        elif 'departamento' in query_lower or 'depto' in query_lower:
-            preferences.property_type = 'departamento'
-        elif 'terreno' in query_lower:
-            preferences.property_type = 'terreno'
-        elif 'oficina' in query_lower:
-            preferences.property_type = 'oficina'
+        preferences.property_type = next(
+            (ptype for ptype in PROPERTY_TYPES.values() if ptype in hits["ptype"]), None
+        )
         
         # Extraer número de dormitorios
-        bedroom_match = re.search(r'(\d+)\s*(?:dormitorio|habitacion|cuarto)', query_lower)
+        bedroom_match = BEDROOM_RE.search(query_lower)
         if bedroom_match:
             preferences.bedrooms = int(bedroom_match.group(1))
         
         # Extraer número de baños
-        bathroom_match = re.search(r'(\d+)\s*baño', query_lower)
+        bathroom_match = BATHROOM_RE.search(query_lower)
         if bathroom_match:
             preferences.bathrooms = int(bathroom_match.group(1))
         
         # Características adicionales
-        features = []
-        feature_keywords = {
-            'piscina': 'piscina',
-            'garage': 'garage',
-            'jardin': 'jardín',
-            'parrillero': 'parrillero',
-            'seguridad': 'seguridad 24/7',
-            'amoblado': 'amoblado',
-            'balcon': 'balcón'
-        }
-        
-        for keyword, feature in feature_keywords.items():
-            if keyword in query_lower:
-                features.append(feature)
-        
-        preferences.additional_features = features
+        preferences.additional_features = [
+            feature for feature in FEATURE_KEYWORDS.values() if feature in hits["feature"]
+        ]
         
         # Detectar urgencia
-        if any(word in query_lower for word in ['urgente', 'pronto', 'ya', 'inmediato', 'hoy']):
+        if 'alta' in hits["urgency"]:
             preferences.urgency = 'alta'
-        elif any(word in query_lower for word in ['próximo mes', 'próxima semana']):
+        elif 'media' in hits["urgency"]:
             preferences.urgency = 'media'
         else:
             preferences.urgency = 'baja'
@@ -277,7 +467,7 @@ async def get_property_ai_description(property_id: str):
         """
         
         # Aquí usarías tu servicio de IA
-        result = ask_mistral_with_context(query=prompt, history="")
+        result = await ask_mistral_with_context_async(query=prompt, history="")
         
         return {
             "success": True,
@@ -296,8 +486,8 @@ async def health_check():
     Verificar el estado del módulo IA y sus componentes.
     """
     try:
-        # Verificar índice FAISS
-        overview = get_index_overview()
+        # Verificar índice FAISS (snapshot en memoria)
+        overview = _health_snapshot
         
         return {
             "success": True,
@@ -314,7 +504,7 @@ async def health_check():
                     "model": "mistral"
                 }
             },
-            "timestamp": datetime.utcnow().isoformat()
+            "timestamp": _now_iso()
         }
         
     except Exception as e:
@@ -323,7 +513,7 @@ async def health_check():
             "service": "ia-module",
             "status": "unhealthy",
             "error": str(e),
-            "timestamp": datetime.utcnow().isoformat()
+            "timestamp": _now_iso()
         }
 
 @router.post("/load-property-docs")
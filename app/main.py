@@ -4,35 +4,62 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.config import Base, engine
 from app.api import chat_router, debug_router
-from app.api.whatsapp_integration import router as whatsapp_router
+from app.api.whatsapp_integration import router as whatsapp_router, refresh_overview_loop
+from app.services.llm_batcher import llm_queue
+from app.services.ia_service import close_async_client
 import os
+import asyncio
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 
 load_dotenv()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Arranque y apagado de los recursos compartidos del módulo"""
+    # Crear tablas si no existen (solo con CREATE_SCHEMA=1, p. ej. en desarrollo)
+    if os.getenv("CREATE_SCHEMA", "0") == "1":
+        await asyncio.to_thread(Base.metadata.create_all, engine)
+
+    # Micro-batcher de consultas al LLM
+    llm_queue.start()
+    # Snapshot del índice FAISS usado por /api/ia/health
+    overview_task = asyncio.create_task(
+        refresh_overview_loop(float(os.getenv("HEALTH_REFRESH_SEC", "30")))
+    )
+    try:
+        yield
+    finally:
+        overview_task.cancel()
+        await llm_queue.stop()
+        await close_async_client()
+
 app = FastAPI(
     title="Módulo IA - Sistema WhatsApp Inmobiliario",
     description="IA con RAG para asistente inmobiliario integrado con WhatsApp",
     version="2.0.0",
+    lifespan=lifespan,
 )
 
 # CORS para permitir peticiones del sistema WhatsApp
+# Por defecto: Gateway (3000), Procesamiento (3002) y Respuestas (3005)
+CORS_ORIGINS = tuple(dict.fromkeys(
+    origin.strip()
+    for origin in os.getenv(
+        "CORS_ORIGINS", "http://localhost:3000,http://localhost:3002,http://localhost:3005"
+    ).split(",")
+    if origin.strip()
+))
+DEV_MODE = os.getenv("DEV", "0") == "1"
+
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=[
-        "http://localhost:3000",  # Gateway
-        "http://localhost:3002",  # Procesamiento
-        "http://localhost:3005",  # Respuestas
-        "*"  # En desarrollo
-    ],
+    allow_origins=list(CORS_ORIGINS) + (["*"] if DEV_MODE else []),  # "*" solo en desarrollo
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "DELETE"],  # DELETE: /chat/{id}
+    allow_headers=["content-type", "authorization"],
 )
 
-# Crear tablas si no existen
-Base.metadata.create_all(bind=engine)
-
 @app.get("/")
 def read_root():
     return {
@@ -65,4 +92,13 @@ app.include_router(debug_router)     # Debug
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("IA_PORT", "3003"))
-    uvicorn.run(app, host="0.0.0.0", port=port, reload=True)
\ No newline at end of file
+    # DEV=1 → un proceso con autoreload; en producción, varios workers
+    reload = DEV_MODE
+    workers = 1 if reload else int(os.getenv("WORKERS", os.cpu_count() or 1))
+    uvicorn.run(
+        "app.main:app",
+        host="0.0.0.0",
+        port=port,
+        reload=reload,
+        workers=workers,
+    )
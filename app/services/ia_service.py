@@ -10,12 +10,15 @@
 import re
 import os
 import json
+import logging
 import faiss
 import pickle
 import numpy as np
+import httpx
+import asyncio
 import requests
 from collections import defaultdict, Counter
-from typing import List, Optional, Tuple, Dict, Iterable
+from typing import List, Optional, Tuple, Dict, Iterable, AsyncIterator
 from sentence_transformers import SentenceTransformer
 
 # Optional: load environment if not done elsewhere
@@ -25,6 +28,8 @@ try:
 except Exception:
     pass
 
+logger = logging.getLogger(__name__)
+
 # --- Config from .env (with sensible defaults) -----------------------
 EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "distiluse-base-multilingual-cased-v1")
 INDEX_FILE = os.getenv("VECTOR_DB_INDEX", "data/vector_db/index.faiss")
@@ -49,6 +54,20 @@ Eres un asistente en español que responde usando SOLO el contexto proporcionado
 # --- Load model, index, and docs once at import time -----------------
 _MODEL: SentenceTransformer = SentenceTransformer(EMBEDDING_MODEL_NAME)
 
+# Shared async HTTP client (connection pooling / keep-alive to Ollama)
+_ASYNC_CLIENT = httpx.AsyncClient(
+    http2=True,
+    timeout=httpx.Timeout(REQUEST_TIMEOUT),
+    limits=httpx.Limits(
+        max_connections=int(os.getenv("OLLAMA_MAX_CONNECTIONS", "100")),
+        max_keepalive_connections=int(os.getenv("OLLAMA_MAX_KEEPALIVE", "20")),
+    ),
+)
+
+async def close_async_client() -> None:
+    """Close the shared Ollama client (call on app shutdown)."""
+    await _ASYNC_CLIENT.aclose()
+
 def _normalize(v: np.ndarray) -> np.ndarray:
     """L2-normalize embeddings to use cosine similarity via inner product."""
     norms = np.linalg.norm(v, axis=1, keepdims=True) + 1e-12
@@ -233,6 +252,75 @@ def ask_mistral_with_context(query: str, history: str = "") -> dict:
 
     return {"question": query, "answer": answer, "used_context": True}
 
+async def ask_mistral_with_context_async(query: str, history: str = "") -> dict:
+    """
+    Async variant of ask_mistral_with_context for FastAPI endpoints:
+    - Retrieval (embedding + FAISS) runs in a worker thread.
+    - Generation awaits Ollama through the shared httpx.AsyncClient,
+      so the event loop is free while the model decodes.
+    """
+    chunks = await asyncio.to_thread(get_relevant_chunks, query)
+    if not chunks:
+        return {"question": query, "answer": "", "used_context": False}
+
+    prompt = _build_prompt(query, chunks, history)
+
+    try:
+        resp = await _ASYNC_CLIENT.post(
+            OLLAMA_API_URL,
+            json={"model": OLLAMA_MODEL_NAME, "prompt": prompt, "stream": False},
+        )
+        if resp.status_code != 200:
+            return {
+                "question": query,
+                "answer": "No se pudo obtener una respuesta del modelo.",
+                "used_context": False,
+            }
+        data = resp.json()
+        answer = data.get("response", "").strip()
+    except httpx.HTTPError:
+        return {"question": query, "answer": "Error de conexión con el modelo de IA.", "used_context": False}
+
+    return {"question": query, "answer": answer, "used_context": True}
+
+async def stream_mistral_with_context(query: str, history: str = "") -> AsyncIterator[str]:
+    """
+    Streaming variant: yields answer fragments as Ollama produces them.
+    - Yields nothing if no relevant context passes the threshold or the
+      model fails before the first fragment (same cases where
+      ask_mistral_with_context reports used_context=False), so callers can
+      fall back to a guidance reply.
+    - A failure after the first fragment just ends the stream (already sent).
+    - Reads Ollama's NDJSON stream line by line (pull-based, so a slow
+      client naturally throttles the upstream read).
+    """
+    chunks = await asyncio.to_thread(get_relevant_chunks, query)
+    if not chunks:
+        return
+
+    prompt = _build_prompt(query, chunks, history)
+
+    try:
+        async with _ASYNC_CLIENT.stream(
+            "POST",
+            OLLAMA_API_URL,
+            json={"model": OLLAMA_MODEL_NAME, "prompt": prompt, "stream": True},
+        ) as resp:
+            if resp.status_code != 200:
+                logger.warning(f"Ollama stream returned HTTP {resp.status_code}")
+                return
+            async for line in resp.aiter_lines():
+                if not line:
+                    continue
+                data = json.loads(line)
+                piece = data.get("response", "")
+                if piece:
+                    yield piece
+                if data.get("done"):
+                    break
+    except (httpx.HTTPError, ValueError) as e:  # ValueError: malformed NDJSON line
+        logger.warning(f"Ollama stream aborted: {e}")
+
 def summarize_corpus(max_items: int = 8) -> dict:
     """
     Return a safe snapshot of the corpus based on metadata only.
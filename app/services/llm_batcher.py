@@ -0,0 +1,173 @@
+# app/services/llm_batcher.py
+# ---------------------------------------------------------------------
+# Micro-batching for RAG + Mistral calls:
+# - A request arriving alone is dispatched right away (no added latency)
+# - During a burst, pending requests are grouped (up to MAX_BATCH, waiting
+#   at most MAX_WAIT_MS for the batch to fill) and fired concurrently
+# - At most MAX_BATCH calls per worker process are in flight against
+#   Ollama; the rest wait in the queue, which is where later batches form
+# - Callers simply `await llm_queue.submit(query, history)`; streamed
+#   answers go through `llm_queue.stream(...)`, which shares the same cap
+# ---------------------------------------------------------------------
+
+import os
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from app.services.ia_service import ask_mistral_with_context_async, stream_mistral_with_context
+
+logger = logging.getLogger(__name__)
+
+# Ollama serves at most OLLAMA_NUM_PARALLEL requests at once per model;
+# more concurrent calls would only queue on the server side. The limit is
+# per worker process: with N uvicorn workers the total is N × MAX_BATCH,
+# so set LLM_MAX_BATCH to about OLLAMA_NUM_PARALLEL // WORKERS.
+MAX_BATCH = int(os.getenv("LLM_MAX_BATCH", os.getenv("OLLAMA_NUM_PARALLEL", "4")))
+MAX_WAIT_MS = int(os.getenv("LLM_MAX_WAIT_MS", "30"))
+
+Batch = List[Tuple[str, str, asyncio.Future]]
+
+class BatchQueue:
+    """Coalesce concurrent LLM requests and cap how many run at once."""
+
+    def __init__(self, max_batch: int = MAX_BATCH, max_wait_ms: int = MAX_WAIT_MS):
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait_ms / 1000
+        self._queue: Optional[asyncio.Queue] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._inflight: Dict[asyncio.Task, Batch] = {}
+        self._staged: Batch = []  # collected but still waiting for slots
+
+    def start(self) -> None:
+        """Create the queue and launch the background worker (call on startup)."""
+        if self._worker is not None:
+            return
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.max_batch)
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Cancel the worker and in-flight batches; every pending caller gets an error (call on shutdown)."""
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+
+        inflight = list(self._inflight.items())
+        for task, _ in inflight:
+            task.cancel()
+        await asyncio.gather(*[task for task, _ in inflight], return_exceptions=True)
+
+        pending = [fut for _, batch in inflight for _, _, fut in batch]
+        pending.extend(fut for _, _, fut in self._staged)
+        self._staged = []
+        while not self._queue.empty():
+            _, _, fut = self._queue.get_nowait()
+            pending.append(fut)
+        for fut in pending:
+            if not fut.done():
+                fut.set_exception(RuntimeError("LLM batch queue detenida"))
+
+    async def submit(self, query: str, history: str = "") -> dict:
+        """Enqueue a request and wait for its result (same shape as ask_mistral_with_context)."""
+        if self._worker is None:
+            # Queue not running (e.g. outside the app lifecycle): call directly
+            return await ask_mistral_with_context_async(query=query, history=history)
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((query, history, fut))
+        return await fut
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold one of the MAX_BATCH in-flight slots (no-op if the queue is not running)."""
+        if self._slots is None or self._worker is None:
+            yield
+            return
+        slots = self._slots
+        await slots.acquire()
+        try:
+            yield
+        finally:
+            slots.release()
+
+    async def stream(self, query: str, history: str = "") -> AsyncIterator[str]:
+        """
+        stream_mistral_with_context holding a slot for the whole stream, so
+        streamed answers count against the same in-flight cap. Close the
+        generator (aclose) to release the slot early.
+        """
+        async with self.slot():
+            upstream = stream_mistral_with_context(query=query, history=history)
+            try:
+                async for piece in upstream:
+                    yield piece
+            finally:
+                await upstream.aclose()  # release the Ollama connection right away
+
+    def _drain(self, batch: Batch) -> None:
+        while len(batch) < self.max_batch and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+
+    async def _collect(self) -> Batch:
+        """
+        Block for the first item and take whatever else is already queued.
+        Only wait (up to max_wait) for more when a burst is in progress.
+        """
+        batch = [await self._queue.get()]
+        self._drain(batch)
+        if len(batch) == 1 or len(batch) >= self.max_batch:
+            return batch
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+            self._drain(batch)
+        return batch
+
+    async def _run(self) -> None:
+        while True:
+            batch = self._staged = await self._collect()
+            # One slot per call: when Ollama is saturated the worker blocks
+            # here and new requests accumulate into the next batch
+            for _ in batch:
+                await self._slots.acquire()
+            task = asyncio.create_task(self._dispatch(batch))
+            self._inflight[task] = batch
+            task.add_done_callback(lambda t: self._inflight.pop(t, None))
+            self._staged = []
+
+    async def _dispatch(self, batch: Batch) -> None:
+        logger.debug(f"Despachando lote LLM de {len(batch)} consultas")
+        await asyncio.gather(*[self._call(q, h, fut) for q, h, fut in batch])
+
+    async def _call(self, query: str, history: str, fut: asyncio.Future) -> None:
+        """Run one call, free its slot and resolve its caller as soon as it finishes."""
+        try:
+            res = await ask_mistral_with_context_async(query=query, history=history)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if not fut.done():
+                fut.set_exception(e)
+        else:
+            if not fut.done():  # caller went away (e.g. client disconnected)
+                fut.set_result(res)
+        finally:
+            self._slots.release()
+
+# Shared instance used by the API routers
+llm_queue = BatchQueue()